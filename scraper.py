@@ -1,13 +1,23 @@
+import asyncio
 import base64
+import contextlib
 import csv
+import hashlib
 import json
 import os
+import random
 import re
+import sqlite3
 import time
-from urllib.parse import urljoin
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Iterable, Optional
+from urllib.parse import urljoin, urlsplit
 
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+from aiolimiter import AsyncLimiter
+from lxml import etree
+from lxml import html as lh
 
 import gspread
 from google.oauth2.service_account import Credentials
@@ -18,18 +28,102 @@ HEADERS = {
                   "(KHTML, like Gecko) Chrome/122.0 Safari/537.36"
 }
 TIMEOUT = 30
+MAX_RETRIES = 5
+RETRY_BACKOFF_SEC = 0.5
+RETRY_MAX_WAIT_SEC = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# кэш товарных страниц между запусками (ETag / Last-Modified); пустая строка — выключить
+HTTP_CACHE_PATH = os.getenv("HTTP_CACHE_PATH", "scrape_cache.sqlite").strip()
+# входит в ключ кэша разобранных товаров: поднять, если поменялись правила разбора
+PARSED_CACHE_VERSION = 1
+# товары, которых столько дней не было ни в одном каталоге, из кэша удаляем
+HTTP_CACHE_MAX_AGE_DAYS = 30
 
 MAX_PAGES_PER_CATALOG = 200
-SLEEP_BETWEEN_REQUESTS_SEC = 0.6
-SLEEP_BETWEEN_PAGES_SEC = 0.8
+MAX_CONCURRENT_REQUESTS = 10
+MAX_REQUESTS_PER_SEC = 5             # на один хост; вместо фиксированных sleep между запросами
+PARSE_WORKERS = os.cpu_count() or 1  # процессы для разбора HTML товаров
 
 HEADER = ["url", "name", "category", "color", "size", "stock"]
 
-SIZE_RE = re.compile(
-    r"^(XS|S|M|L|XL|XXL|XXXL|XXXS|ONE SIZE|OS|O/S|"
-    r"US\s?\d+([.,]\d+)?|EU\s?\d+([.,]\d+)?|"
-    r"\d+([.,]\d+)?)$",
-    re.IGNORECASE
+# метки переходов в ссылках каталога — на содержимое страницы товара не влияют
+TRACKING_PARAMS = frozenset(["ref", "from", "gclid", "yclid", "fbclid"])
+SHEETS_MAX_RETRIES = 5
+SHEETS_MAX_WAIT_SEC = 64  # потолок паузы между повторами, в т.ч. для Retry-After
+
+# инлайновые JS/JSON-LD и стили на странице товара — сотни КБ, которые нам не нужны;
+# вырезаем по байтам ещё до декодирования, чтобы парсер их даже не токенизировал
+# (noscript не трогаем: его текст, как и в BeautifulSoup, попадает в разбор)
+SCRIPT_STYLE_RE = re.compile(rb"<(script|style)(?=[\s>/])[^>]*>.*?</\1\s*>", re.I | re.S)
+# <?xml ... encoding=...?> в начале XHTML: lxml не принимает его в str (ValueError),
+# а HTML-парсеру он и не нужен — текст уже декодирован
+XML_DECL_RE = re.compile(r"[\ufeff\s]*<\?xml[^>]*>")
+# кодировка из <meta charset=...> / <meta http-equiv content="...; charset=...">,
+# если сервер не указал её в Content-Type
+META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.I)
+
+# размер: буквенный (сравниваем с множеством, без regex) или числовой, в т.ч. "US 9" / "EU 42,5";
+# проверяем строку уже в верхнем регистре
+SIZE_WORDS = frozenset([
+    "XS", "S", "M", "L", "XL", "XXL", "XXXL", "XXXS", "ONE SIZE", "OS", "O/S"
+])
+SIZE_NUM_RE = re.compile(r"(?:US\s?|EU\s?)?\d+(?:[.,]\d+)?")
+
+LETTER_RE = re.compile(r"[A-Za-zА-Яа-я]")
+
+# строки с такими словами — точно не цвет (цены, кнопки, статусы)
+NOT_COLOR_RE = re.compile("|".join(map(re.escape, [
+    "₽", "руб", "в сплит", "добавить", "корзин", "купить",
+    "нет в наличии", "в наличии", "предзаказ", "sale", "скидк",
+    "размер", "цвет"
+])))
+
+# XPath компилируем один раз при импорте, а не на каждой странице.
+# Каждый запрос — один проход по descendant-оси с условием через "or": объединение
+# нескольких путей через "|" (как получается из CSS "a, b, c") обходит DOM по разу
+# на каждую часть и потом ещё сортирует результат.
+
+# аналог CSS ".name": у элемента есть класс name
+HAS_CLASS = "contains(concat(' ', normalize-space(@class), ' '), ' {} ')"
+
+# блоки выбора размера/варианта: [data-size] или один из классов целиком
+# (подстрока не годится — под неё попадают font-size-lg, size-chart и т.п.)
+SIZE_PICKER_CLASSES = (
+    "size", "sizes", "size-item", "size-list", "sizes-list",
+    "product-size", "product-sizes", "product__size", "product__sizes",
+    "swatch", "swatches", "variant", "variants", "product-variants", "product__variants",
+)
+SIZE_PICKERS_XP = etree.XPath(
+    "descendant::*[@data-size or (@class and (contains(@class, 'size')"
+    " or contains(@class, 'swatch') or contains(@class, 'variant'))"
+    " and (" + " or ".join(HAS_CLASS.format(c) for c in SIZE_PICKER_CLASSES) + "))]"
+)
+SIZE_OPTIONS_XP = etree.XPath("descendant::option[ancestor::select]")
+# normalize-space() в XPath 1.0 схлопывает только ASCII-пробелы; nbsp и прочие юникодные
+# пробелы (по которым режет str.split в clean_text) сначала переводим в обычный пробел.
+# Управляющие \x0b, \x0c, \x1c-\x1f в XPath не записать, да и в HTML-тексте их не бывает
+UNICODE_SPACES = "".join(c for c in map(chr, range(0x80, 0x3001)) if c.isspace())
+NORMALIZED_TEXT = f"normalize-space(translate(., '{UNICODE_SPACES}', '{' ' * len(UNICODE_SPACES)}'))"
+# кандидаты в кнопки размеров; короткий текст у a/button/span/div отсекаем ещё в libxml2,
+# чтобы не гонять через Python тысячи длинных карточек/блоков
+SIZE_BUTTONS_XP = etree.XPath(
+    "descendant-or-self::*[(self::a or self::button or self::span or self::div)"
+    f" and normalize-space(.) != '' and string-length({NORMALIZED_TEXT}) <= 10]"
+)
+# nav.breadcrumbs a, .breadcrumbs a, [aria-label='breadcrumb'] a, .breadcrumb a
+BREADCRUMBS_XP = etree.XPath(
+    "descendant::a[ancestor::*[@aria-label = 'breadcrumb'"
+    " or (@class and contains(@class, 'breadcrumb')"
+    f" and ({HAS_CLASS.format('breadcrumbs')} or {HAS_CLASS.format('breadcrumb')}))]]"
+)
+# .properties, .product-properties, .characteristics, .product-params, .product__properties
+PROPS_XP = etree.XPath(
+    "descendant-or-self::*[@class and (contains(@class, 'propert')"
+    " or contains(@class, 'characteristics') or contains(@class, 'product-params'))]"
+    "[" + " or ".join(HAS_CLASS.format(c) for c in (
+        "properties", "product-properties", "characteristics", "product-params", "product__properties"
+    )) + "]"
 )
 
 
@@ -38,13 +132,190 @@ def log(msg: str):
 
 
 def clean_text(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "")).strip()
+    # str.split() режет по тем же пробельным символам, что и \s (включая nbsp),
+    # и для коротких строк в разы быстрее re.sub + strip
+    return " ".join(s.split()) if s else ""
+
+
+def make_session() -> aiohttp.ClientSession:
+    """
+    Одна сессия на весь прогон: заголовки и таймаут задаются один раз,
+    TCP/TLS-соединения с магазином переиспользуются (keep-alive),
+    а DNS-ответы кэшируются на 5 минут.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=20,
+        limit_per_host=MAX_CONCURRENT_REQUESTS,
+        keepalive_timeout=30,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+    )
+
+
+@contextlib.asynccontextmanager
+async def get_with_retries(session: aiohttp.ClientSession, url: str, headers: Optional[dict] = None,
+                           limiter: Optional[AsyncLimiter] = None):
+    """
+    GET с повторами: на 429/5xx, обрыв соединения и таймаут до получения ответа.
+    Ошибки при чтении тела уже у вызывающего не повторяем — часть ответа могла быть обработана.
+    limiter — token bucket хоста (создаётся в amain), берём токен на каждую попытку.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            await limiter.acquire()
+        retry_after = ""
+        try:
+            r = await session.get(url, headers=headers)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            reason = str(e) or type(e).__name__
+        else:
+            if r.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                async with r:
+                    r.raise_for_status()
+                    yield r
+                return
+            reason = f"ответ {r.status}"
+            retry_after = r.headers.get("Retry-After", "")
+            r.release()
+        # временная ошибка сервера / rate limit — ждём, сколько просит Retry-After,
+        # иначе экспоненциально со случайной добавкой, чтобы параллельные запросы
+        # не возвращались к серверу все в один момент; в любом случае не дольше
+        # RETRY_MAX_WAIT_SEC — ожидание держит слот семафора хоста
+        if retry_after.isdigit():
+            wait = min(int(retry_after), RETRY_MAX_WAIT_SEC)
+        else:
+            wait = min(RETRY_BACKOFF_SEC * 2 ** attempt, RETRY_MAX_WAIT_SEC) + random.uniform(0, RETRY_BACKOFF_SEC)
+        log(f"  {url}: {reason}, повтор через {wait:.1f} с")
+        await asyncio.sleep(wait)
+
+
+CACHE_TABLES = ("http_cache", "parsed_cache")
+
+
+def open_http_cache(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    # seen_at — когда товар последний раз встречался в каталоге (см. prune_http_cache)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS http_cache ("
+        "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body TEXT, seen_at REAL)"
+    )
+    # результат разбора: digest — sha1 от HTML (с версией правил), data — JSON товара
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS parsed_cache ("
+        "url TEXT PRIMARY KEY, digest TEXT, data TEXT, seen_at REAL)"
+    )
+    # файлы кэша от прошлых версий — без seen_at
+    for table in CACHE_TABLES:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if "seen_at" not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN seen_at REAL")
+    return conn
+
+
+def prune_http_cache(conn: sqlite3.Connection, seen_urls: Iterable[str]):
+    """
+    Отмечаем товары этого прогона и удаляем те, что не попадались дольше
+    HTTP_CACHE_MAX_AGE_DAYS: иначе тела страниц снятых с продажи товаров копятся вечно.
+    Срок, а не «всё, чего не было сейчас» — чтобы каталог, оборвавшийся на ошибке,
+    не стёр кэш целиком.
+    """
+    now = time.time()
+    seen_urls = list(seen_urls)
+    for table in CACHE_TABLES:
+        conn.executemany(f"UPDATE {table} SET seen_at = ? WHERE url = ?", ((now, u) for u in seen_urls))
+        conn.execute(
+            f"DELETE FROM {table} WHERE seen_at IS NULL OR seen_at < ?",
+            (now - HTTP_CACHE_MAX_AGE_DAYS * 86400,),
+        )
+    conn.commit()
+
+
+def decode_body(body: bytes, charset: Optional[str]) -> str:
+    """
+    Кодировка: из заголовка, иначе из <meta> в начале страницы, иначе utf-8.
+    Битые байты заменяем, а не падаем — как requests r.text.
+    """
+    if not charset:
+        m = META_CHARSET_RE.search(body, 0, 4096)
+        charset = m.group(1).decode("ascii") if m else "utf-8"
+    try:
+        return body.decode(charset, errors="replace")
+    except LookupError:  # неизвестное имя кодировки
+        return body.decode("utf-8", errors="replace")
 
 
-def fetch(url: str) -> str:
-    r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
-    r.raise_for_status()
-    return r.text
+async def fetch_async(session: aiohttp.ClientSession, url: str,
+                      cache: Optional[sqlite3.Connection] = None,
+                      limiter: Optional[AsyncLimiter] = None) -> str:
+    """
+    С кэшем делаем условный GET: если страница не менялась, сервер отвечает
+    304 без тела, и мы отдаём сохранённую копию.
+    Сроков годности нет — наличие меняется, поэтому каждый раз спрашиваем сервер.
+    """
+    headers = {}
+    cached = None
+    if cache is not None:
+        cached = cache.execute(
+            "SELECT etag, last_modified, body FROM http_cache WHERE url = ?", (url,)
+        ).fetchone()
+        if cached:
+            if cached[0]:
+                headers["If-None-Match"] = cached[0]
+            if cached[1]:
+                headers["If-Modified-Since"] = cached[1]
+
+    async with get_with_retries(session, url, headers, limiter) as r:
+        if r.status == 304 and cached:
+            return cached[2]
+        body = SCRIPT_STYLE_RE.sub(b"", await r.read())
+        html = decode_body(body, r.charset)
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+
+    if cache is not None and (etag or last_modified):
+        cache.execute(
+            "INSERT OR REPLACE INTO http_cache (url, etag, last_modified, body) VALUES (?, ?, ?, ?)",
+            (url, etag, last_modified, html),
+        )
+    return html
+
+
+async def fetch_catalog_hrefs(session: aiohttp.ClientSession, url: str,
+                             limiter: Optional[AsyncLimiter] = None) -> list[str]:
+    """
+    Страницу каталога разбираем по мере загрузки: куски ответа сразу уходят
+    в потоковый парсер lxml, а href ссылок на товары собираются по событиям.
+    """
+    hrefs = []
+
+    def collect(parser: etree.HTMLPullParser):
+        for _, a in parser.read_events():
+            href = a.get("href")
+            if href and "/product/" in href:
+                hrefs.append(href)
+            a.clear(keep_tail=True)
+            # всё, что в документе стоит раньше этой ссылки (кроме её предков), уже разобрано —
+            # удаляем, иначе дерево всей страницы копится в парсере до конца загрузки
+            el, parent = a, a.getparent()
+            while parent is not None:
+                while el.getprevious() is not None:
+                    del parent[0]
+                el, parent = parent, parent.getparent()
+
+    async with get_with_retries(session, url, limiter=limiter) as r:
+        parser = etree.HTMLPullParser(events=("end",), tag="a", encoding=r.charset)
+        async for chunk in r.content.iter_chunked(16384):
+            parser.feed(chunk)
+            collect(parser)
+    parser.close()
+    collect(parser)
+    return hrefs
 
 
 def load_catalog_urls() -> list[str]:
@@ -60,40 +331,86 @@ def catalog_page_url(catalog_url: str, page: int) -> str:
     return f"{catalog_url}{sep}page={page}"
 
 
-def get_breadcrumb_category(soup: BeautifulSoup) -> str:
-    crumbs = soup.select(
-        "nav.breadcrumbs a, .breadcrumbs a, [aria-label='breadcrumb'] a, .breadcrumb a"
-    )
-    txts = [clean_text(c.get_text(" ", strip=True)) for c in crumbs]
+def html_to_tree(html: str) -> lh.HtmlElement:
+    # комментарии и пробельные текстовые узлы нам не нужны — не строим их вовсе,
+    # индекс id тоже не нужен; парсер на вызов (дёшево), т.к. его нельзя делить между потоками
+    parser = lh.HTMLParser(remove_comments=True, remove_blank_text=True, collect_ids=False)
+    decl = XML_DECL_RE.match(html)
+    if decl:
+        html = html[decl.end():]
+    # пустое тело (или одни скрипт/комментарии, вырезанные выше) — пустой документ,
+    # а не ParserError: товар остаётся в выгрузке строкой с пустыми полями, как было с bs4
+    if not html.strip():
+        return lh.Element("html")
+    try:
+        tree = lh.document_fromstring(html, parser=parser)
+    except etree.ParserError:
+        return lh.Element("html")
+    # как и BeautifulSoup, не считаем текстом содержимое script/style/template
+    etree.strip_elements(tree, "script", "style", "template", with_tail=False)
+    return tree
+
+
+def node_text(el: lh.HtmlElement) -> str:
+    """Аналог bs4 get_text(" ", strip=True) + clean_text."""
+    return clean_text(" ".join(el.itertext()))
+
+
+def node_strings(el: lh.HtmlElement) -> list[str]:
+    """Аналог bs4 stripped_strings (с clean_text для каждой строки)."""
+    return [t for t in map(clean_text, el.itertext()) if t]
+
+
+def get_breadcrumb_category(tree: lh.HtmlElement) -> str:
+    crumbs = BREADCRUMBS_XP(tree)
+    txts = [node_text(c) for c in crumbs]
     txts = [t for t in txts if t]
     if len(txts) >= 2:
         return " / ".join(txts[-4:])
     return ""
 
 
-def extract_product_links_from_catalog(soup: BeautifulSoup, base_url: str) -> list[str]:
+def canonical_product_url(url: str) -> str:
+    """
+    Один товар — один URL: убираем #якорь и utm_*/ref-метки, чтобы одна и та же
+    карточка со ссылками ?ref=... с разных страниц не качалась повторно.
+    Остальные параметры (например, variant_id) оставляем как есть.
+    """
+    url = url.partition("#")[0]
+    path, sep, query = url.partition("?")
+    if not sep:
+        return url
+    kept = []
+    for p in query.split("&"):
+        key = p.partition("=")[0].lower()
+        if p and key not in TRACKING_PARAMS and not key.startswith("utm_"):
+            kept.append(p)
+    return f"{path}?{'&'.join(kept)}" if kept else path
+
+
+def extract_product_links_from_catalog(hrefs: Iterable[str], base_url: str) -> list[str]:
     """
     Kixbox/InSales: ссылки на товары содержат /product/
     """
-    urls = []
-    for a in soup.select('a[href*="/product/"]'):
-        href = a.get("href", "")
-        if not href:
-            continue
-        full = urljoin(base_url, href)
-        if "/product/" not in full:
-            continue
-        urls.append(full)
-
-    # уникализируем с сохранением порядка
-    seen = set()
-    uniq = []
-    for u in urls:
-        if u in seen:
-            continue
-        seen.add(u)
-        uniq.append(u)
-    return uniq
+    # обычный случай — абсолютная ссылка или путь от корня сайта; собираем строкой,
+    # urljoin (с разбором обоих URL) оставляем для относительных и "/./", "/../"
+    base = urlsplit(base_url)
+    origin = f"{base.scheme}://{base.netloc}"
+
+    # ключи dict сохраняют порядок вставки — это и есть уникализация с сохранением порядка
+    uniq: dict[str, None] = {}
+    for href in hrefs:
+        if "/." in href:
+            full = urljoin(base_url, href)
+        elif href.startswith(("https://", "http://")):
+            full = href
+        elif href.startswith("/") and not href.startswith("//"):
+            full = origin + href
+        else:
+            full = urljoin(base_url, href)
+        if "/product/" in full:
+            uniq[canonical_product_url(full)] = None
+    return list(uniq)
 
 
 def parse_stock_from_text(page_text_lower: str) -> str:
@@ -108,54 +425,97 @@ def looks_like_color(text: str) -> bool:
     t = clean_text(text)
     if not t:
         return False
-    tl = t.lower()
-    bad = [
-        "₽", "руб", "в сплит", "добавить", "корзин", "купить",
-        "нет в наличии", "в наличии", "предзаказ", "sale", "скидк",
-        "размер", "цвет"
-    ]
-    if any(b in tl for b in bad):
+    if NOT_COLOR_RE.search(t.lower()):
         return False
-    if 2 <= len(t) <= 40 and re.search(r"[A-Za-zА-Яа-я]", t):
+    if 2 <= len(t) <= 40 and LETTER_RE.search(t):
         return True
     return False
 
 
-def parse_product_page(product_url: str) -> dict:
-    html = fetch(product_url)
-    soup = BeautifulSoup(html, "lxml")
+async def parse_product_page(session: aiohttp.ClientSession, product_url: str,
+                             cache: Optional[sqlite3.Connection] = None,
+                             pool: Optional[Executor] = None,
+                             limiter: Optional[AsyncLimiter] = None) -> dict:
+    html = await fetch_async(session, product_url, cache, limiter)
+    return await parse_product_html_cached(html, product_url, cache, pool)
+
+
+async def parse_product_html_cached(html: str, product_url: str,
+                                    cache: Optional[sqlite3.Connection] = None,
+                                    pool: Optional[Executor] = None) -> dict:
+    # страница не изменилась (304 или тот же HTML без ETag) — берём прошлый разбор
+    digest = None
+    if cache is not None:
+        digest = hashlib.sha1(f"{PARSED_CACHE_VERSION}\n{html}".encode()).hexdigest()
+        cached = cache.execute(
+            "SELECT digest, data FROM parsed_cache WHERE url = ?", (product_url,)
+        ).fetchone()
+        if cached and cached[0] == digest:
+            return json.loads(cached[1])
+
+    # парсинг — CPU-работа: уводим из event loop в пул процессов (GIL не мешает разбирать
+    # несколько страниц сразу); без пула — в стандартный пул потоков
+    loop = asyncio.get_running_loop()
+    prod = await loop.run_in_executor(pool, parse_product_html, html, product_url)
+
+    if cache is not None:
+        cache.execute(
+            "INSERT OR REPLACE INTO parsed_cache (url, digest, data) VALUES (?, ?, ?)",
+            (product_url, digest, json.dumps(prod, ensure_ascii=False)),
+        )
+    return prod
+
+
+def size_picker_buttons(tree: lh.HtmlElement) -> list[lh.HtmlElement]:
+    """Кандидаты в кнопки размеров внутри блоков выбора размера/варианта, в порядке документа."""
+    picked = set()
+    buttons = []
+    for box in SIZE_PICKERS_XP(tree):
+        # вложенный блок (span.size внутри div.sizes) уже покрыт внешним
+        if any(a in picked for a in box.iterancestors()):
+            continue
+        picked.add(box)
+        buttons.extend(SIZE_BUTTONS_XP(box))
+    return buttons
+
+
+def parse_product_html(html: str, product_url: str) -> dict:
+    tree = html_to_tree(html)
 
     # NAME
     name = ""
-    h1 = soup.select_one("h1")
-    if h1:
-        name = clean_text(h1.get_text(" ", strip=True))
+    h1 = tree.find(".//h1")
+    if h1 is not None:
+        name = node_text(h1)
 
     # CATEGORY
-    category = get_breadcrumb_category(soup)
+    category = get_breadcrumb_category(tree)
+
+    # все текстовые строки страницы собираем за один обход DOM — ниже они нужны несколько раз
+    texts = node_strings(tree)
 
-    # STOCK (эвристика по тексту)
-    page_text = clean_text(soup.get_text(" ", strip=True))
-    page_text_lower = page_text.lower()
+    # STOCK (эвристика по тексту): склеиваем уже собранные строки (скриптов в них нет)
+    # и ищем фразы в одном буфере — это быстрее, чем lower() и поиск по каждой строке
+    page_text_lower = " ".join(texts).lower()
     stock = parse_stock_from_text(page_text_lower)
 
     # COLOR (эвристики)
     color = ""
 
-    # 1) строка вида "Цвет: XXX"
-    for s in soup.stripped_strings:
-        t = clean_text(s)
-        if t.lower().startswith("цвет:"):
-            cand = clean_text(t.split(":", 1)[1])
-            if looks_like_color(cand):
-                color = cand
-                break
+    # 1) строка вида "Цвет: XXX"; нет подстроки во всём тексте — и по строкам не ищем
+    if "цвет:" in page_text_lower:
+        for t in texts:
+            if t.lower().startswith("цвет:"):
+                cand = clean_text(t.split(":", 1)[1])
+                if looks_like_color(cand):
+                    color = cand
+                    break
 
-    # 2) блок характеристик
+    # 2) блок характеристик (маленькие поддеревья — обходим отдельно)
     if not color:
-        props = soup.select(".properties, .product-properties, .characteristics, .product-params, .product__properties")
+        props = PROPS_XP(tree)
         for p in props:
-            txts = [clean_text(x) for x in p.stripped_strings]
+            txts = node_strings(p)
             for i, tt in enumerate(txts):
                 if tt.lower() in ("цвет", "color"):
                     if i + 1 < len(txts) and looks_like_color(txts[i + 1]):
@@ -166,32 +526,39 @@ def parse_product_page(product_url: str) -> dict:
 
     # 3) фоллбек: первая “похожая” строка
     if not color:
-        candidates = []
-        for s in soup.stripped_strings:
-            st = clean_text(s)
-            if st and looks_like_color(st) and st != name:
-                candidates.append(st)
-        if candidates:
-            color = candidates[0]
-
-    # SIZES
+        for st in texts:
+            if st != name and looks_like_color(st):
+                color = st
+                break
+
+    # SIZES (уникальные, в порядке появления: сначала select option, потом кнопки/ссылки)
     sizes = []
+    seen_sizes = set()
+    size_num = SIZE_NUM_RE.fullmatch
 
     # select options
-    for opt in soup.select("select option"):
-        t = clean_text(opt.get_text(" ", strip=True))
-        if SIZE_RE.match(t):
-            sizes.append(t.upper().replace("  ", " "))
-
-    # кнопки/ссылки размеров
-    for el in soup.select("a, button, span, div"):
-        t = clean_text(el.get_text(" ", strip=True))
-        if not t:
-            continue
-        if SIZE_RE.match(t) and len(t) <= 10:
-            sizes.append(t.upper().replace("  ", " "))
-
-    sizes = list(dict.fromkeys(sizes))
+    for opt in SIZE_OPTIONS_XP(tree):
+        t = node_text(opt).upper()
+        if t not in seen_sizes and (t in SIZE_WORDS or size_num(t)):
+            seen_sizes.add(t)
+            sizes.append(t)
+
+    def add_buttons(buttons: Iterable[lh.HtmlElement]):
+        for el in buttons:
+            t = node_text(el)
+            if len(t) > 10:
+                continue
+            t = t.upper()
+            if t not in seen_sizes and (t in SIZE_WORDS or size_num(t)):
+                seen_sizes.add(t)
+                sizes.append(t)
+
+    # кнопки/ссылки размеров: сначала только внутри блоков выбора размера,
+    # по всей странице (тысячи коротких span/div) — лишь если блоки ничего не добавили
+    found = len(sizes)
+    add_buttons(size_picker_buttons(tree))
+    if len(sizes) == found:
+        add_buttons(SIZE_BUTTONS_XP(tree))
 
     return {
         "url": product_url,
@@ -247,53 +614,111 @@ def init_sheet():
     return ws
 
 
+def sheets_call(fn, *args, **kwargs):
+    """
+    Вызов Sheets API с повтором при 429 (квота запросов в минуту) и 5xx:
+    ждём столько, сколько просит Retry-After, иначе — экспоненциально;
+    в обоих случаях не дольше SHEETS_MAX_WAIT_SEC.
+    """
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            # HTTP-статус берём из ответа: у HTML-страниц 502/503 нет JSON-тела, и gspread ставит e.code = -1
+            status = e.response.status_code
+            if (status != 429 and status < 500) or attempt == SHEETS_MAX_RETRIES:
+                raise
+            retry_after = e.response.headers.get("Retry-After", "")
+            wait = min(int(retry_after) if retry_after.isdigit() else 2 ** attempt, SHEETS_MAX_WAIT_SEC)
+            log(f"Google Sheets ответил {status}, повтор через {wait} с")
+            time.sleep(wait)
+
+
 def sheet_reset(ws):
-    ws.clear()
-    ws.update([HEADER], value_input_option="RAW")
+    sheets_call(ws.clear)
+    sheets_call(ws.update, [HEADER], value_input_option="RAW")
 
 
-def sheet_append_rows(ws, rows: list[list[str]]):
-    ws.append_rows(rows, value_input_option="RAW")
+def sheet_write_rows(ws, rows: list[tuple], chunk_size: int):
+    """
+    Пишем все строки разом (values.update) начиная со 2-й строки — под заголовком.
+    Если строк больше chunk_size, режем на несколько больших запросов.
+    """
+    need_rows = len(rows) + 1
+    if ws.row_count < need_rows:
+        sheets_call(ws.add_rows, need_rows - ws.row_count)
+
+    written = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        sheets_call(ws.update, values=chunk, range_name=f"A{start + 2}", value_input_option="RAW")
+        written += len(chunk)
+        log(f"Записал в Google Sheets: +{len(chunk)} строк (итого {written})")
 
 
-def save_csv_fallback(all_rows: list[dict], path: str = "output.csv"):
+@contextlib.contextmanager
+def open_csv_fallback(path: str = "output.csv"):
+    """CSV-запасник, который пишется по ходу обхода: при падении уже собранное остаётся на диске."""
     with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=HEADER)
-        w.writeheader()
-        w.writerows(all_rows)
+        w = csv.writer(f)
+        w.writerow(HEADER)
+        f.flush()
 
+        def write_rows(page_rows: list[tuple]):
+            w.writerows(page_rows)
+            f.flush()
 
-def main():
-    # батч
+        yield write_rows
+
+
+async def amain():
+    # сколько строк отправлять в Sheets одним запросом
     try:
-        batch_size = int(os.getenv("SHEETS_BATCH_SIZE", "300").strip())
+        # 0 и отрицательные значения ломают range(..., step) в sheet_write_rows
+        batch_size = max(1, int(os.getenv("SHEETS_BATCH_SIZE", "10000").strip()))
     except Exception:
-        batch_size = 300
+        batch_size = 10000
 
     catalog_urls = load_catalog_urls()
     if not catalog_urls:
         log("catalog.txt пустой — нечего парсить.")
         return
 
-    # Инициализируем Sheets
+    # Sheets открываем сразу, чтобы неверные ключи упали до обхода; очищаем таблицу
+    # только перед записью — пока идёт обход, в ней остаются данные прошлого запуска
     ws = init_sheet()
-    sheet_reset(ws)
-    log("Google Sheet очищен и заголовок записан. Начинаю парсинг...")
-
-    all_rows_dict: list[dict] = []      # запасной CSV
-    buffer_rows: list[list[str]] = []   # батч на запись в Sheets
-    total_written = 0
-
-    def flush_buffer():
-        nonlocal total_written, buffer_rows
-        if not buffer_rows:
-            return
-        sheet_append_rows(ws, buffer_rows)
-        total_written += len(buffer_rows)
-        log(f"Записал в Google Sheets: +{len(buffer_rows)} строк (итого {total_written})")
-        buffer_rows = []
-
-    for catalog_url in catalog_urls:
+    log("Google Sheet доступен. Начинаю парсинг...")
+
+    visited: set[str] = set()           # товары, уже взятые в работу (между страницами и каталогами)
+
+    # вежливость — на хост, а не глобально: разные магазины не ждут друг друга
+    host_sems: defaultdict[str, asyncio.Semaphore] = defaultdict(
+        lambda: asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    )
+    # token bucket на хост: если сервер сам отвечает медленно, ждать дополнительно не приходится.
+    # Живёт в рамках прогона, как и семафоры: AsyncLimiter привязан к своему event loop
+    rate_limiters: defaultdict[str, AsyncLimiter] = defaultdict(
+        lambda: AsyncLimiter(MAX_REQUESTS_PER_SEC, 1)
+    )
+    cache = open_http_cache(HTTP_CACHE_PATH) if HTTP_CACHE_PATH else None
+
+    def host_sem(url: str) -> asyncio.Semaphore:
+        return host_sems[urlsplit(url).hostname or ""]
+
+    def host_limiter(url: str) -> AsyncLimiter:
+        return rate_limiters[urlsplit(url).hostname or ""]
+
+    async def bounded_parse(session: aiohttp.ClientSession, i: int, total: int, product_url: str) -> dict:
+        # слот хоста держим только на время загрузки: разбор в пуле процессов
+        # идёт параллельно со следующими запросами к магазину
+        async with host_sem(product_url):
+            log(f"    [{i}/{total}] {product_url}")
+            html = await fetch_async(session, product_url, cache, host_limiter(product_url))
+        return await parse_product_html_cached(html, product_url, cache, pool)
+
+    async def crawl_catalog(session: aiohttp.ClientSession, catalog_url: str) -> list[tuple]:
+        rows: list[tuple] = []          # строки в порядке HEADER: и для Sheets, и для CSV
+        catalog_seen: set[str] = set()  # ссылки, уже встречавшиеся на страницах этого каталога
         log(f"\n=== Каталог: {catalog_url} ===")
 
         for page in range(1, MAX_PAGES_PER_CATALOG + 1):
@@ -301,62 +726,79 @@ def main():
             log(f"Страница {page}: {page_url}")
 
             try:
-                html = fetch(page_url)
+                async with host_sem(page_url):
+                    hrefs = await fetch_catalog_hrefs(session, page_url, host_limiter(page_url))
             except Exception as e:
-                log(f"  Ошибка загрузки страницы каталога: {e}")
+                log(f"  Ошибка загрузки страницы каталога {page_url}: {e}")
                 break
 
-            soup = BeautifulSoup(html, "lxml")
-            product_links = extract_product_links_from_catalog(soup, base_url=catalog_url)
+            product_links = extract_product_links_from_catalog(hrefs, base_url=catalog_url)
 
             if not product_links:
-                log("  Товаров на странице не найдено — считаю, что каталог закончился.")
+                log(f"  {page_url}: товаров на странице не найдено — считаю, что каталог закончился.")
+                break
+
+            # InSales на номерах страниц за концом каталога часто отдаёт последнюю
+            # (или первую) страницу ещё раз — если ничего нового для каталога нет, дальше не идём
+            if catalog_seen.issuperset(product_links):
+                log(f"  {page_url}: новых товаров на странице нет — считаю, что каталог закончился.")
                 break
+            catalog_seen.update(product_links)
+
+            found = len(product_links)
+            product_links = [u for u in product_links if u not in visited]
+            visited.update(product_links)
+            log(f"  {page_url}: нашёл ссылок на товары: {found} (новых: {len(product_links)})")
+
+            # все товары страницы качаем параллельно; gather сохраняет порядок ссылок
+            results = await asyncio.gather(
+                *(bounded_parse(session, i, len(product_links), u) for i, u in enumerate(product_links, 1)),
+                return_exceptions=True,
+            )
+
+            page_rows: list[tuple] = []
+            for product_url, prod in zip(product_links, results):
+                if isinstance(prod, Exception):
+                    log(f"      Ошибка парсинга товара {product_url}: {prod}")
+                    continue
+
+                # по строке на каждый размер; товар без размеров — одна строка с пустым size
+                for size in prod["sizes"] or [""]:
+                    page_rows.append((
+                        prod["url"], prod["name"], prod["category"],
+                        prod["color"], size, prod["stock"]
+                    ))
+
+            # страницу сразу дописываем в CSV, в Sheets всё уйдёт одним заходом в конце
+            write_csv(page_rows)
+            rows.extend(page_rows)
+
+            if cache is not None:
+                cache.commit()
+
+        return rows
+
+    # каталоги обходим параллельно; каждый копит свои строки, склеиваем в порядке catalog.txt.
+    # CSV пишется по мере готовности страниц (в порядке обхода), так что если упадёт
+    # сам обход или Sheets, собранные данные не потеряются
+    with open_csv_fallback("output.csv") as write_csv, \
+            ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+        async with make_session() as session:
+            per_catalog = await asyncio.gather(*(crawl_catalog(session, c) for c in catalog_urls))
+    all_rows = [row for rows in per_catalog for row in rows]
+
+    if cache is not None:
+        prune_http_cache(cache, visited)
+        cache.close()
 
-            log(f"  Нашёл ссылок на товары: {len(product_links)}")
-
-            for i, product_url in enumerate(product_links, 1):
-                try:
-                    log(f"    [{i}/{len(product_links)}] {product_url}")
-                    prod = parse_product_page(product_url)
-
-                    if prod["sizes"]:
-                        for size in prod["sizes"]:
-                            row = {
-                                "url": prod["url"],
-                                "name": prod["name"],
-                                "category": prod["category"],
-                                "color": prod["color"],
-                                "size": size,
-                                "stock": prod["stock"]
-                            }
-                            all_rows_dict.append(row)
-                            buffer_rows.append([row[k] for k in HEADER])
-                    else:
-                        row = {
-                            "url": prod["url"],
-                            "name": prod["name"],
-                            "category": prod["category"],
-                            "color": prod["color"],
-                            "size": "",
-                            "stock": prod["stock"]
-                        }
-                        all_rows_dict.append(row)
-                        buffer_rows.append([row[k] for k in HEADER])
-
-                    if len(buffer_rows) >= batch_size:
-                        flush_buffer()
-
-                except Exception as e:
-                    log(f"      Ошибка парсинга товара: {e}")
-
-                time.sleep(SLEEP_BETWEEN_REQUESTS_SEC)
-
-            time.sleep(SLEEP_BETWEEN_PAGES_SEC)
-
-    flush_buffer()
-    save_csv_fallback(all_rows_dict, "output.csv")
-    log("Готово. Таблица заполнена по ходу работы, CSV сохранён как запасной вариант (output.csv).")
+    sheet_reset(ws)
+    log("Google Sheet очищен и заголовок записан.")
+    sheet_write_rows(ws, all_rows, batch_size)
+    log("Готово. Таблица заполнена, CSV сохранён как запасной вариант (output.csv).")
+
+
+def main():
+    asyncio.run(amain())
 
 
 if __name__ == "__main__":